@@ -3,27 +3,269 @@ RunPod Serverless Handler: FFmpeg Video Stitcher with Audio Overlay
 
 Uses pure FFmpeg (no MoviePy) - simpler and more reliable.
 Supports optional audio track muxing for narration/music overlay.
-Uploads result to Supabase storage and returns URL (avoids base64 memory issues).
+Uploads result to S3-compatible or Supabase storage and returns URL
+(avoids base64 memory issues). For MP4, S3 uploads and the base64 fallback
+read FFmpeg's output straight from its stdout, so the result never touches disk.
+Those outputs are fragmented MP4 (empty moov, one fragment per keyframe);
+Supabase and RunPod bucket uploads, and all WebM output, are regular files.
 
 Dockerfile requirements:
 - Python 3.10+
 - ffmpeg (system package)
 - runpod>=1.3.0
 - requests>=2.28.0
+- pybase64>=1.3.0
+- boto3>=1.26.0
 
 Environment Variables (set in RunPod):
+- MAX_DOWNLOAD_WORKERS: Parallel segment downloads (optional, default 16)
+- S3_BUCKET: Bucket for S3-compatible uploads (S3, R2, MinIO)
+- S3_ENDPOINT: Custom endpoint URL (optional, required for R2/MinIO)
+- S3_URL_EXPIRES: Presigned URL lifetime in seconds (optional, default 3600)
+- AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY: Credentials for S3 uploads
 - SUPABASE_URL: Supabase project URL
 - SUPABASE_SERVICE_ROLE_KEY: Service role key for storage uploads
+- BUCKET_ENDPOINT_URL / BUCKET_ACCESS_KEY_ID / BUCKET_SECRET_ACCESS_KEY:
+  RunPod bucket upload credentials (used when S3/Supabase are not set)
+- BUCKET_NAME: Bucket for RunPod uploads (optional, defaults to RunPod's MM-YY)
 """
 
 import os
+import re
+import errno
+import json
+import shutil
 import tempfile
 import subprocess
+import threading
 import requests
 import runpod
-import base64
-from typing import List, Optional
+import pybase64
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from typing import Any, BinaryIO, Callable, List, Optional, Tuple
 from datetime import datetime
+from uuid import uuid4
+from functools import lru_cache
+
+# Upper bound on concurrent segment downloads (also sizes the HTTP connection pool).
+# Invalid values fall back to the default rather than failing worker start.
+try:
+    MAX_DOWNLOAD_WORKERS = max(1, int(os.environ.get("MAX_DOWNLOAD_WORKERS", 16)))
+except ValueError:
+    MAX_DOWNLOAD_WORKERS = 16
+
+# Protocols FFmpeg may open when the concat list references segment URLs
+PROTOCOL_WHITELIST = "file,http,https,tcp,tls"
+
+# Per-segment options for URL inputs so dropped connections are resumed
+HTTP_INPUT_OPTIONS = [
+    ("reconnect", "1"),
+    ("reconnect_streamed", "1"),
+    ("reconnect_delay_max", "10"),
+]
+
+# Shared across jobs so segment downloads reuse TCP/TLS connections. The
+# pool holds one connection per download worker plus one for the audio
+# download that runs alongside them; transient gateway errors are retried
+# with backoff.
+HTTP_SESSION = requests.Session()
+HTTP_ADAPTER = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=MAX_DOWNLOAD_WORKERS + 1,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+)
+HTTP_SESSION.mount("http://", HTTP_ADAPTER)
+HTTP_SESSION.mount("https://", HTTP_ADAPTER)
+
+# RAM-backed temp location, used when the job's known file sizes fit in its free space
+SHM_DIR = "/dev/shm"
+
+# Buffer size for copying response bodies to disk
+DOWNLOAD_BUFFER_SIZE = 1024 * 1024
+
+# Read size for base64 encoding; a multiple of 3 so only the final block is
+# padded, and small enough (192 KiB in, 256 KiB out) to stay resident in L2
+BASE64_READ_SIZE = 192 * 1024
+
+# Multipart settings for S3 uploads
+S3_MULTIPART_THRESHOLD = 8 * 1024 * 1024
+S3_MAX_CONCURRENCY = 8
+
+# Re-encode fallback settings per output container. -threads 0 lets the
+# encoder use every core; libvpx-vp9 also needs row-mt to scale past a few.
+VIDEO_ENCODE_ARGS = {
+    ".mp4": [
+        "-c:v", "libx264",
+        "-preset", "veryfast",
+        "-tune", "fastdecode",
+        "-crf", "23",
+        "-threads", "0",
+        "-x264-params", "threads=auto:lookahead_threads=2:sliced_threads=0",
+    ],
+    ".webm": [
+        "-c:v", "libvpx-vp9",
+        "-crf", "32", "-b:v", "0",
+        "-row-mt", "1",
+        "-cpu-used", "4",
+        "-threads", "0",
+    ],
+}
+
+# GPU re-encode settings for mp4 output when NVENC is usable
+NVENC_ENCODE_ARGS = [
+    "-c:v", "h264_nvenc",
+    "-preset", "p4",
+    "-tune", "hq",
+    "-rc", "vbr",
+    "-cq", "23",
+    "-b:v", "0",
+]
+
+# WebM cannot carry AAC, so audio is encoded to Opus there
+AUDIO_CODECS = {".mp4": "aac", ".webm": "libopus"}
+
+# Matches the key=value lines FFmpeg writes for `-progress`
+PROGRESS_LINE = re.compile(rb"^([a-z0-9_]+)=(.*)$")
+
+
+class OutputSinkError(Exception):
+    """Raised when streaming FFmpeg output to its destination fails."""
+
+
+class FFmpegFailedError(Exception):
+    """Raised to an output sink reading FFmpeg's stdout when FFmpeg exits with an error."""
+
+
+class InputReadError(Exception):
+    """
+    Raised when FFmpeg exits cleanly but logged errors reading its inputs.
+    
+    The concat demuxer skips a segment it cannot open or decode (e.g. a
+    URL whose HEAD succeeded but whose GET fails, or a file that is not
+    video) and still exits 0 with a truncated video.
+    """
+
+
+class RemoteReadError(Exception):
+    """Raised when segments read over HTTP cannot be stream-copied; download them and retry."""
+
+
+class TempSpaceError(Exception):
+    """Raised when a download does not fit in the job's temp directory."""
+
+
+class FFmpegOutput:
+    """
+    Read-only view of a running FFmpeg's stdout, handed to output sinks.
+    
+    At EOF it waits for FFmpeg to exit and raises FFmpegFailedError if the
+    run failed (or, with fail_on_errors, logged any error). A sink is then
+    interrupted instead of finishing with a partial video: upload_fileobj
+    aborts its multipart upload and never puts a single-part object.
+    """
+    
+    def __init__(self, proc: subprocess.Popen, fail_on_errors: bool = False):
+        self.proc = proc
+        self.fail_on_errors = fail_on_errors
+        self.rejected = False
+        self.result = None
+        self.stderr_chunks = []
+        self.stderr_reader = threading.Thread(
+            target=lambda: self.stderr_chunks.append(proc.stderr.read())
+        )
+        self.stderr_reader.start()
+    
+    def read(self, size: int = -1) -> bytes:
+        if self.result is not None:
+            return b""
+        data = self.proc.stdout.read(size)
+        if not data and size != 0:
+            returncode, _, errors = self.finish()
+            if returncode != 0 or (self.fail_on_errors and errors):
+                self.rejected = True
+                raise FFmpegFailedError(f"FFmpeg exited with {returncode}: {errors[:200]}")
+        return data
+    
+    def finish(self) -> Tuple[int, dict, str]:
+        """Wait for FFmpeg and return (returncode, progress values, error text)."""
+        if self.result is None:
+            # Closing stdout stops FFmpeg if the sink gave up before EOF
+            self.proc.stdout.close()
+            returncode = self.proc.wait()
+            self.stderr_reader.join()
+            self.proc.stderr.close()
+            progress, errors = parse_ffmpeg_stderr(b"".join(self.stderr_chunks))
+            self.result = (returncode, progress, errors)
+        return self.result
+
+
+def unique_filename(ext: str) -> str:
+    """Return a storage filename that won't collide with concurrent jobs."""
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    return f"runpod_{timestamp}_{uuid4().hex}{ext}"
+
+
+def get_s3_client() -> Optional[Tuple[Any, str]]:
+    """Return (client, bucket) for S3-compatible storage, or None if not configured."""
+    bucket = os.environ.get("S3_BUCKET")
+    
+    if not bucket:
+        print("S3 bucket not configured, skipping S3 upload")
+        return None
+    
+    try:
+        import boto3
+    except ImportError:
+        print("boto3 not installed, skipping S3 upload")
+        return None
+    
+    s3 = boto3.client("s3", endpoint_url=os.environ.get("S3_ENDPOINT") or None)
+    return s3, bucket
+
+
+def upload_stream_to_s3(stream: BinaryIO, s3: Any, bucket: str, ext: str = ".mp4") -> str:
+    """Upload a binary stream to S3-compatible storage and return a presigned URL."""
+    from boto3.s3.transfer import TransferConfig
+    
+    # Generate unique key
+    key = f"stitched/{unique_filename(ext)}"
+    
+    content_type = "video/webm" if ext == ".webm" else "video/mp4"
+    expires_in = int(os.environ.get("S3_URL_EXPIRES", 3600))
+    
+    print(f"Streaming upload to S3: {bucket}/{key}")
+    
+    # Multipart parts are uploaded in parallel while FFmpeg keeps writing
+    config = TransferConfig(
+        multipart_threshold=S3_MULTIPART_THRESHOLD,
+        max_concurrency=S3_MAX_CONCURRENCY
+    )
+    s3.upload_fileobj(
+        stream, bucket, key,
+        ExtraArgs={"ContentType": content_type},
+        Config=config
+    )
+    presigned_url = s3.generate_presigned_url(
+        "get_object",
+        Params={"Bucket": bucket, "Key": key},
+        ExpiresIn=expires_in
+    )
+    print(f"Upload successful: {bucket}/{key}")
+    return presigned_url
+
+
+def upload_to_s3(file_path: str, s3: Any, bucket: str) -> Optional[str]:
+    """Upload a finished file to S3-compatible storage and return a presigned URL."""
+    ext = os.path.splitext(file_path)[1] or ".mp4"
+    try:
+        with open(file_path, "rb") as f:
+            advise_sequential(f)
+            return upload_stream_to_s3(f, s3, bucket, ext)
+    except Exception as e:
+        print(f"S3 upload error: {str(e)}")
+        return None
 
 
 def upload_to_supabase(file_path: str, bucket: str = "persona-videos") -> Optional[str]:
@@ -32,16 +274,16 @@ def upload_to_supabase(file_path: str, bucket: str = "persona-videos") -> Option
     service_key = os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
     
     if not supabase_url or not service_key:
-        print("Supabase credentials not configured, falling back to base64")
+        print("Supabase credentials not configured, skipping Supabase upload")
         return None
     
     # Generate unique filename
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     ext = os.path.splitext(file_path)[1] or ".mp4"
-    filename = f"stitched/runpod_{timestamp}{ext}"
+    filename = f"stitched/{unique_filename(ext)}"
     
     # Read file
     with open(file_path, "rb") as f:
+        advise_sequential(f)
         file_data = f.read()
     
     # Determine content type
@@ -71,11 +313,59 @@ def upload_to_supabase(file_path: str, bucket: str = "persona-videos") -> Option
         return None
 
 
-def download_file(url: str, temp_dir: str, prefix: str, index: int = 0) -> str:
+def runpod_bucket_configured() -> bool:
+    """Whether all credentials rp_upload needs for a real bucket upload are set."""
+    # Without keys rp_upload copies the file to ./local_upload and returns a local path
+    return all(
+        os.environ.get(name)
+        for name in ("BUCKET_ENDPOINT_URL", "BUCKET_ACCESS_KEY_ID", "BUCKET_SECRET_ACCESS_KEY")
+    )
+
+
+def upload_to_runpod_bucket(file_path: str) -> Optional[str]:
+    """Upload file with RunPod's bucket helper and return a presigned URL."""
+    if not runpod_bucket_configured():
+        print("RunPod bucket not configured, skipping bucket upload")
+        return None
+    
+    from runpod.serverless.utils import rp_upload
+    
+    # Generate unique filename
+    ext = os.path.splitext(file_path)[1] or ".mp4"
+    filename = unique_filename(ext)
+    
+    content_type = "video/webm" if ext == ".webm" else "video/mp4"
+    
+    print(f"Uploading to RunPod bucket: stitched/{filename}")
+    
+    try:
+        presigned_url = rp_upload.upload_file_to_bucket(
+            filename,
+            file_path,
+            bucket_name=os.environ.get("BUCKET_NAME"),
+            prefix="stitched",
+            extra_args={"ContentType": content_type}
+        )
+        if not str(presigned_url).startswith(("http://", "https://")):
+            print(f"RunPod bucket upload returned no URL: {presigned_url}")
+            return None
+        print(f"Upload successful: stitched/{filename}")
+        return presigned_url
+    except Exception as e:
+        print(f"RunPod bucket upload error: {str(e)}")
+        return None
+
+
+def download_file(
+    url: str,
+    temp_dir: str,
+    prefix: str,
+    index: int = 0
+) -> str:
     """Download a file from URL to a temporary file."""
     print(f"[{prefix}{index}] Downloading: {url[:80]}...")
     
-    response = requests.get(url, stream=True, timeout=120)
+    response = HTTP_SESSION.get(url, stream=True, timeout=120)
     response.raise_for_status()
     
     # Detect extension from URL or content-type
@@ -97,9 +387,22 @@ def download_file(url: str, temp_dir: str, prefix: str, index: int = 0) -> str:
     
     filepath = os.path.join(temp_dir, f"{prefix}_{index:03d}{ext}")
     
-    with open(filepath, "wb") as f:
-        for chunk in response.iter_content(chunk_size=8192):
-            f.write(chunk)
+    # On RAM-backed /dev/shm, leave room for the output when the length is
+    # known; a full /dev/shm is reported the same way so the job can move to disk
+    in_shm = is_in_shm(temp_dir)
+    content_length = response.headers.get("content-length", "")
+    if in_shm and content_length.isdigit() and int(content_length) > shutil.disk_usage(temp_dir).free // 2:
+        raise TempSpaceError(f"{int(content_length):,} byte download does not fit in {temp_dir}")
+    
+    # Copy the raw stream in large blocks; decode_content keeps gzip/deflate handling
+    response.raw.decode_content = True
+    try:
+        with open(filepath, "wb") as f:
+            shutil.copyfileobj(response.raw, f, length=DOWNLOAD_BUFFER_SIZE)
+    except OSError as e:
+        if in_shm and e.errno == errno.ENOSPC:
+            raise TempSpaceError(f"No space left in {temp_dir}") from e
+        raise
     
     file_size = os.path.getsize(filepath)
     print(f"[{prefix}{index}] Downloaded: {file_size:,} bytes -> {filepath}")
@@ -107,6 +410,188 @@ def download_file(url: str, temp_dir: str, prefix: str, index: int = 0) -> str:
     return filepath
 
 
+def download_segments(urls: List[str], temp_dir: str) -> List[str]:
+    """Download all segments in parallel, returning paths in input order."""
+    workers = min(MAX_DOWNLOAD_WORKERS, len(urls))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # map() preserves input order, so the paths match the urls list
+        return list(executor.map(
+            lambda item: download_file(item[1], temp_dir, "segment", item[0]),
+            enumerate(urls)
+        ))
+
+
+def get_content_length(url: str) -> Optional[int]:
+    """HEAD a URL and return its Content-Length, or None if unavailable."""
+    try:
+        response = HTTP_SESSION.head(url, allow_redirects=True, timeout=30)
+        response.raise_for_status()
+        return int(response.headers["content-length"])
+    except (requests.RequestException, KeyError, ValueError):
+        return None
+
+
+def get_remote_sizes(urls: List[str]) -> List[Optional[int]]:
+    """
+    HEAD every URL concurrently and return their Content-Lengths in order.
+    
+    A size is None if the URL is not http(s), fails the HEAD request, or
+    does not report its length.
+    """
+    workers = min(MAX_DOWNLOAD_WORKERS, len(urls))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(
+            lambda url: get_content_length(url) if is_remote(url) else None,
+            urls
+        ))
+
+
+def is_remote(source: str) -> bool:
+    """Whether a segment source is a URL rather than a downloaded file."""
+    return source.startswith(("http://", "https://"))
+
+
+def advise_sequential(f: BinaryIO) -> None:
+    """Tell the kernel an open file will be read once, front to back."""
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+
+def drop_page_cache(filepath: str) -> None:
+    """Release a file's cached pages once nothing will read it again."""
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(filepath, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+
+def is_in_shm(path: str) -> bool:
+    """Whether path is inside the RAM-backed SHM_DIR."""
+    shm_dir = os.path.abspath(SHM_DIR)
+    return os.path.commonpath([os.path.abspath(path), shm_dir]) == shm_dir
+
+
+def choose_temp_root(segment_sizes: List[Optional[int]], audio_size: Optional[int] = 0) -> Optional[str]:
+    """
+    Pick /dev/shm for job files when they fit, else the default temp dir.
+    
+    Sizes are the HEAD lengths of the segments and audio track; if any is
+    unknown the total can't be bounded and the job goes to disk. Downloads
+    into /dev/shm still raise TempSpaceError if it fills up regardless.
+    """
+    if audio_size is None or any(size is None for size in segment_sizes):
+        return None
+    
+    if not os.path.isdir(SHM_DIR):
+        return None
+    
+    try:
+        shm_free = shutil.disk_usage(SHM_DIR).free
+    except OSError:
+        return None
+    
+    # Downloaded segments, an output of similar size and the audio track must
+    # fit (counting the segments even when FFmpeg reads them over HTTP, in
+    # case it falls back to downloading them)
+    expected_bytes = 2 * sum(segment_sizes) + audio_size
+    if expected_bytes > shm_free:
+        print(f"Job files (~{expected_bytes:,} bytes) too large for {SHM_DIR}, using disk")
+        return None
+    return SHM_DIR
+
+
+def download_inputs(
+    segments: List[str],
+    audio_url: Optional[str],
+    temp_dir: str,
+    read_remote: bool
+) -> Tuple[List[str], Optional[str]]:
+    """
+    Download the audio track and, unless FFmpeg reads them over HTTP, the segments.
+    
+    An audio download failure only drops the audio (video-only output);
+    TempSpaceError always propagates so the caller can move to disk.
+    
+    Returns:
+        (segment paths or URLs, audio path or None)
+    """
+    # Download the audio track while the segments are downloaded
+    with ThreadPoolExecutor(max_workers=1) as audio_executor:
+        audio_future = None
+        if audio_url:
+            audio_future = audio_executor.submit(download_file, audio_url, temp_dir, "audio", 0)
+        
+        # Let FFmpeg read segments straight from their URLs when every
+        # server answered HEAD with a length; otherwise download them first.
+        if read_remote:
+            print("Segments readable over HTTP, skipping download")
+            segment_paths = list(segments)
+        else:
+            segment_paths = download_segments(segments, temp_dir)
+    
+    audio_path = None
+    if audio_future is not None:
+        try:
+            audio_path = audio_future.result()
+        except TempSpaceError:
+            raise
+        except Exception as audio_err:
+            print(f"Audio download error: {str(audio_err)}")
+            print("Continuing with video-only output")
+    
+    return segment_paths, audio_path
+
+
+def encode_file_base64(filepath: str, prefix: str = "", file_size: Optional[int] = None) -> str:
+    """
+    Base64-encode a file block by block instead of reading it into memory at once.
+    
+    The prefix (e.g. a data URI header) is written into the same buffer, so
+    the result is decoded to str exactly once with no further concatenation.
+    file_size (if already known) presizes the buffer without a stat call.
+    """
+    if file_size is None:
+        file_size = os.stat(filepath).st_size
+    header = prefix.encode("ascii")
+    encoded = bytearray(len(header) + 4 * ((file_size + 2) // 3))
+    encoded[:len(header)] = header
+    offset = len(header)
+    
+    with open(filepath, "rb") as f:
+        advise_sequential(f)
+        while True:
+            chunk = f.read(BASE64_READ_SIZE)
+            if not chunk:
+                break
+            block = pybase64.b64encode(chunk)
+            encoded[offset:offset + len(block)] = block
+            offset += len(block)
+    
+    # Trim in case file_size overstated the file
+    del encoded[offset:]
+    return encoded.decode("ascii")
+
+
+def encode_stream_base64(stream: BinaryIO, prefix: str = "") -> str:
+    """Base64-encode a binary stream (e.g. FFmpeg stdout) as it is read, after prefix."""
+    encoded = bytearray(prefix.encode("ascii"))
+    
+    # Buffered read(n) only returns a short block at EOF, so padding stays at the end
+    while True:
+        chunk = stream.read(BASE64_READ_SIZE)
+        if not chunk:
+            break
+        encoded += pybase64.b64encode(chunk)
+    
+    return encoded.decode("ascii")
+
+
 def get_video_duration(filepath: str) -> float:
     """Get video duration using ffprobe."""
     cmd = [
@@ -122,172 +607,557 @@ def get_video_duration(filepath: str) -> float:
         return 0.0
 
 
-def stitch_videos_ffmpeg(segment_paths: List[str], output_path: str) -> dict:
-    """Concatenate video segments using FFmpeg concat demuxer."""
-    print(f"Stitching {len(segment_paths)} segments with FFmpeg...")
+def probe_segment(filepath: str) -> dict:
+    """Get a segment's video stream parameters, audio presence and duration with one ffprobe call."""
+    cmd = [
+        "ffprobe", "-v", "error",
+        "-show_entries",
+        "stream=codec_type,codec_name,width,height,pix_fmt,r_frame_rate:format=duration",
+        "-of", "json",
+        filepath
+    ]
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    try:
+        info = json.loads(result.stdout)
+    except ValueError:
+        info = {}
     
-    # Create concat file list
-    temp_dir = os.path.dirname(output_path)
-    concat_file = os.path.join(temp_dir, "concat_list.txt")
+    streams = info.get("streams") or []
+    video_streams = [stream for stream in streams if stream.pop("codec_type", None) == "video"]
+    try:
+        duration = float(info.get("format", {}).get("duration"))
+    except (TypeError, ValueError):
+        duration = 0.0
     
-    with open(concat_file, "w") as f:
-        for path in segment_paths:
-            # FFmpeg concat requires escaped paths
-            escaped_path = path.replace("'", "'\\''")
-            f.write(f"file '{escaped_path}'\n")
+    return {
+        "video": video_streams[0] if video_streams else None,
+        "has_audio": len(video_streams) < len(streams),
+        "duration": duration
+    }
+
+
+def probe_segments(segment_paths: List[str]) -> List[dict]:
+    """Probe all segments concurrently, preserving input order."""
+    workers = min(len(segment_paths), os.cpu_count() or 4)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(probe_segment, segment_paths))
+
+
+def segments_compatible(probes: List[dict]) -> bool:
+    """Check whether segments share video parameters, so stream copy can work."""
+    streams = [probe["video"] for probe in probes]
+    
+    if any(stream is None for stream in streams):
+        # Unknown parameters: let the stream copy attempt decide
+        return True
+    
+    for i, stream in enumerate(streams[1:], start=1):
+        if stream != streams[0]:
+            print(f"Segment {i} differs from segment 0: {stream} vs {streams[0]}")
+            return False
+    return True
+
+
+def parse_ffmpeg_stderr(stderr: bytes) -> Tuple[dict, str]:
+    """Split FFmpeg stderr into the final `-progress` values and the error text."""
+    progress = {}
+    error_lines = []
+    
+    for line in stderr.splitlines():
+        match = PROGRESS_LINE.match(line.strip())
+        if match:
+            progress[match.group(1).decode("ascii")] = match.group(2).decode("utf-8", "replace")
+        else:
+            error_lines.append(line)
+    
+    return progress, b"\n".join(error_lines).decode("utf-8", "replace")
+
+
+def progress_duration(progress: dict) -> Optional[float]:
+    """
+    Output duration in seconds from FFmpeg progress values, if reported.
+    
+    out_time is the timestamp of the last packet written, so this runs
+    about one frame short of the container duration ffprobe reports.
+    """
+    # out_time_ms is also in microseconds; older FFmpeg builds only emit that key
+    for key in ("out_time_us", "out_time_ms"):
+        try:
+            return int(progress[key]) / 1_000_000
+        except (KeyError, ValueError):
+            continue
+    return None
+
+
+def progress_size(progress: dict) -> int:
+    """Output size in bytes from FFmpeg progress values (0 if not reported)."""
+    try:
+        return int(progress["total_size"])
+    except (KeyError, ValueError):
+        return 0
+
+
+def run_ffmpeg(
+    cmd: List[str],
+    output_sink: Optional[Callable[[BinaryIO], Any]] = None,
+    fail_on_errors: bool = False
+) -> Tuple[int, dict, str, Any]:
+    """
+    Run an FFmpeg command and parse its stderr.
+    
+    With an output_sink, FFmpeg's stdout is handed to the sink (wrapped in
+    FFmpegOutput) while the command runs. stderr is drained on a separate
+    thread so progress output cannot fill the pipe and stall FFmpeg. If
+    FFmpeg fails, the sink is interrupted at EOF and the failure is
+    returned like any other, not raised as OutputSinkError.
+    
+    Returns:
+        (returncode, progress values, error text, sink result)
+    
+    Raises:
+        InputReadError: with fail_on_errors, if FFmpeg exited 0 but logged errors
+    """
+    if output_sink is None:
+        result = subprocess.run(cmd, capture_output=True)
+        returncode = result.returncode
+        progress, errors = parse_ffmpeg_stderr(result.stderr)
+        sink_result = None
+    else:
+        returncode, progress, errors, sink_result = run_ffmpeg_to_sink(
+            cmd, output_sink, fail_on_errors
+        )
+    
+    if fail_on_errors and returncode == 0 and errors:
+        raise InputReadError(f"FFmpeg reported errors reading inputs: {errors}")
+    return returncode, progress, errors, sink_result
+
+
+def run_ffmpeg_to_sink(
+    cmd: List[str],
+    output_sink: Callable[[BinaryIO], Any],
+    fail_on_errors: bool = False
+) -> Tuple[int, dict, str, Any]:
+    """Run FFmpeg with its stdout handed to output_sink (see run_ffmpeg)."""
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output = FFmpegOutput(proc, fail_on_errors)
+    
+    try:
+        sink_result = output_sink(output)
+    except Exception as e:
+        # Only errors from the sink itself count as sink failures
+        if not output.rejected:
+            output.finish()
+            raise OutputSinkError(str(e)) from e
+        sink_result = None
     
-    print(f"Concat file created: {concat_file}")
+    returncode, progress, errors = output.finish()
+    return returncode, progress, errors, sink_result
+
+
+@lru_cache(maxsize=None)
+def nvenc_available() -> bool:
+    """Check (once per worker) whether FFmpeg can encode with h264_nvenc."""
+    result = subprocess.run(["ffmpeg", "-hide_banner", "-encoders"], capture_output=True, text=True)
+    if "h264_nvenc" not in result.stdout:
+        return False
+    
+    # Distro builds list NVENC even without a GPU, so confirm with a tiny encode
+    cmd = [
+        "ffmpeg", "-hide_banner", "-loglevel", "error",
+        "-f", "lavfi", "-i", "color=c=black:s=256x256:d=0.1",
+        "-c:v", "h264_nvenc",
+        "-f", "null", "-"
+    ]
+    available = subprocess.run(cmd, capture_output=True).returncode == 0
+    print(f"NVENC available: {available}")
+    return available
+
+
+def use_nvenc(output_path: str) -> bool:
+    """Whether the re-encode fallback for this output should run on the GPU."""
+    return not output_path.endswith(".webm") and nvenc_available()
+
+
+def build_stitch_cmd(
+    concat_file: str,
+    output_path: str,
+    reencode: bool = False,
+    audio_path: Optional[str] = None,
+    audio_filters: Optional[List[str]] = None,
+    stream_output: bool = False,
+    use_gpu: bool = False
+) -> List[str]:
+    """
+    Build the FFmpeg concat command, optionally muxing an audio track in the same pass.
     
-    # Run FFmpeg concat
+    With stream_output, fragmented MP4 is written to stdout instead of
+    output_path so it can be produced without seeking. WebM is not
+    streamed: its Duration and Cues are only written to a seekable file.
+    With reencode and use_gpu, decoding and encoding run on NVENC/CUDA.
+    """
     cmd = [
         "ffmpeg", "-y",
+        "-nostats", "-loglevel", "error",  # Keep stderr to actual errors
+        "-progress", "pipe:2",             # Final out_time gives the duration
+    ]
+    
+    if reencode and use_gpu:
+        # Decode on the GPU and keep frames there for the encoder
+        cmd.extend(["-hwaccel", "cuda", "-hwaccel_output_format", "cuda"])
+    
+    cmd.extend([
+        "-protocol_whitelist", PROTOCOL_WHITELIST,
         "-f", "concat",
         "-safe", "0",
         "-i", concat_file,
-        "-c", "copy",  # Stream copy (fast, no re-encoding)
-        output_path
+    ])
+    
+    ext = ".webm" if output_path.endswith(".webm") else ".mp4"
+    audio_codec = AUDIO_CODECS[ext]
+    
+    if audio_path:
+        cmd.extend([
+            "-i", audio_path,
+            "-map", "0:v:0",      # Video from concat list
+            "-map", "1:a:0",      # Audio from overlay track
+        ])
+    
+    if reencode and use_gpu:
+        cmd.extend(NVENC_ENCODE_ARGS)
+    elif reencode:
+        cmd.extend(VIDEO_ENCODE_ARGS[ext])
+    elif audio_path:
+        cmd.extend(["-c:v", "copy"])  # Copy video codec (no re-encode)
+    else:
+        cmd.extend(["-c", "copy"])  # Stream copy (fast, no re-encoding)
+    
+    if audio_path:
+        cmd.extend([
+            "-c:a", audio_codec,  # Encode audio (AAC for mp4, Opus for webm)
+            "-b:a", "192k",       # Audio bitrate
+            "-shortest",          # Match video duration
+        ])
+        if audio_filters:
+            cmd.extend(["-af", ",".join(audio_filters)])
+    elif reencode:
+        cmd.extend(["-c:a", audio_codec, "-b:a", "128k"])
+    
+    cmd.extend(output_target_args(output_path, stream_output))
+    return cmd
+
+
+def build_filter_concat_cmd(
+    segment_paths: List[str],
+    probes: List[dict],
+    output_path: str,
+    audio_path: Optional[str] = None,
+    audio_filters: Optional[List[str]] = None,
+    stream_output: bool = False,
+    use_gpu: bool = False
+) -> List[str]:
+    """
+    Build an FFmpeg command that decodes each segment as its own input and joins them with the concat filter.
+    
+    Used when segments differ in codec or video parameters, which the concat
+    demuxer cannot decode across. Every segment is scaled (letterboxed) to
+    the first segment's size and converted to its frame rate and yuv420p.
+    Segments without audio get silence when others have audio, since the
+    concat filter needs the same streams from every input.
+    """
+    cmd = [
+        "ffmpeg", "-y",
+        "-nostats", "-loglevel", "error",
+        "-progress", "pipe:2",
     ]
     
-    print(f"Running: {' '.join(cmd)}")
-    result = subprocess.run(cmd, capture_output=True, text=True)
+    for path in segment_paths:
+        cmd.extend(["-i", path])
     
-    if result.returncode != 0:
-        print(f"FFmpeg stderr: {result.stderr}")
-        # Try with re-encoding if stream copy fails
-        cmd = [
-            "ffmpeg", "-y",
-            "-f", "concat",
-            "-safe", "0",
-            "-i", concat_file,
-            "-c:v", "libx264",
-            "-preset", "fast",
-            "-crf", "23",
-            "-c:a", "aac",
-            "-b:a", "128k",
-            output_path
-        ]
-        print(f"Retrying with re-encode: {' '.join(cmd)}")
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        
-        if result.returncode != 0:
-            raise Exception(f"FFmpeg failed: {result.stderr}")
+    if audio_path:
+        cmd.extend(["-i", audio_path])
     
-    output_size = os.path.getsize(output_path)
-    duration = get_video_duration(output_path)
+    first_video = probes[0]["video"]
+    width, height = first_video["width"], first_video["height"]
+    frame_rate = first_video["r_frame_rate"]
+    segment_audio = not audio_path and any(probe["has_audio"] for probe in probes)
     
-    print(f"Output: {output_size:,} bytes, {duration:.2f}s")
+    filters = []
+    concat_inputs = ""
+    for i, probe in enumerate(probes):
+        filters.append(
+            f"[{i}:v:0]scale={width}:{height}:force_original_aspect_ratio=decrease,"
+            f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar=1,"
+            f"fps={frame_rate},format=yuv420p[v{i}]"
+        )
+        concat_inputs += f"[v{i}]"
+        if segment_audio:
+            if probe["has_audio"]:
+                filters.append(f"[{i}:a:0]aresample=48000,aformat=channel_layouts=stereo[a{i}]")
+            else:
+                filters.append(f"anullsrc=r=48000:cl=stereo,atrim=0:{probe['duration']}[a{i}]")
+            concat_inputs += f"[a{i}]"
     
-    return {
-        "success": True,
-        "duration": duration,
-        "file_size_bytes": output_size,
-        "segments_count": len(segment_paths)
-    }
+    if segment_audio:
+        filters.append(f"{concat_inputs}concat=n={len(probes)}:v=1:a=1[outv][outa]")
+    else:
+        filters.append(f"{concat_inputs}concat=n={len(probes)}:v=1:a=0[outv]")
+    cmd.extend(["-filter_complex", ";".join(filters), "-map", "[outv]"])
+    
+    ext = ".webm" if output_path.endswith(".webm") else ".mp4"
+    audio_codec = AUDIO_CODECS[ext]
+    
+    # Frames come out of the CPU filter graph, so only the encoder uses the GPU
+    cmd.extend(NVENC_ENCODE_ARGS if use_gpu else VIDEO_ENCODE_ARGS[ext])
+    
+    if audio_path:
+        cmd.extend([
+            "-map", f"{len(segment_paths)}:a:0",
+            "-c:a", audio_codec,
+            "-b:a", "192k",
+            "-shortest",
+        ])
+        if audio_filters:
+            cmd.extend(["-af", ",".join(audio_filters)])
+    elif segment_audio:
+        cmd.extend(["-map", "[outa]", "-c:a", audio_codec, "-b:a", "128k"])
+    
+    cmd.extend(output_target_args(output_path, stream_output))
+    return cmd
+
 
+def output_target_args(output_path: str, stream_output: bool) -> List[str]:
+    """Output arguments: fragmented MP4 on stdout when streaming, else output_path."""
+    if stream_output:
+        return ["-f", "mp4", "-movflags", "+frag_keyframe+empty_moov", "pipe:1"]
+    return [output_path]
 
-def mux_audio_to_video(
-    video_path: str, 
-    audio_path: str, 
+
+def stitch_videos_ffmpeg(
+    segment_paths: List[str],
     output_path: str,
+    audio_path: Optional[str] = None,
     audio_volume: float = 1.0,
-    fade_out_seconds: float = 0.0
+    fade_out_seconds: float = 0.0,
+    output_sink: Optional[Callable[[BinaryIO], Any]] = None,
+    probes: Optional[List[dict]] = None
 ) -> dict:
     """
-    Mux audio track into video using FFmpeg.
+    Concatenate video segments using FFmpeg concat demuxer.
+    
+    When an audio track is given it is muxed in the same FFmpeg pass
+    (concat list as input 0, audio as input 1), so the stitched video
+    is never written out and read back as an intermediate file. Segments
+    whose video parameters differ are re-encoded through the concat
+    filter instead (see build_filter_concat_cmd). Segment URLs are only
+    ever stream-copied; anything needing a re-encode raises
+    RemoteReadError so the caller downloads the segments first.
     
     Args:
-        video_path: Path to input video
-        audio_path: Path to audio file (wav, mp3, aac, m4a)
-        output_path: Path for output video with audio
+        segment_paths: Paths (or http(s) URLs) of input video segments, in order
+        output_path: Path for output video (only its directory and extension
+            are used when streaming to output_sink)
+        audio_path: Path to audio file to overlay (wav, mp3, aac, m4a), optional
         audio_volume: Volume multiplier (1.0 = original, 0.5 = half)
         fade_out_seconds: Apply fade out at end (0 = no fade)
+        output_sink: Callable that consumes FFmpeg's stdout; its return value
+            is stored under "output". If unset, the output is written to disk.
+        probes: probe_segments() results for segment_paths, so callers that
+            retry can probe once; probed here if not given
     
     Returns:
         dict with success status and metadata
+    
+    Raises:
+        OutputSinkError: if output_sink fails (no re-encode retry is attempted)
+        InputReadError: if FFmpeg exited 0 but logged errors reading the inputs
+        RemoteReadError: if segment URLs would need re-encoding
     """
-    print(f"Muxing audio into video...")
-    print(f"  Video: {video_path}")
-    print(f"  Audio: {audio_path}")
+    print(f"Stitching {len(segment_paths)} segments with FFmpeg...")
+    if audio_path:
+        print(f"  Audio: {audio_path}")
     
-    video_duration = get_video_duration(video_path)
+    if probes is None:
+        probes = probe_segments(segment_paths)
+    compatible = segments_compatible(probes)
     
     # Build audio filter chain
     audio_filters = []
     
-    # Volume adjustment
-    if audio_volume != 1.0:
-        audio_filters.append(f"volume={audio_volume}")
-    
-    # Fade out at end of video
-    if fade_out_seconds > 0 and video_duration > fade_out_seconds:
-        fade_start = video_duration - fade_out_seconds
-        audio_filters.append(f"afade=t=out:st={fade_start}:d={fade_out_seconds}")
-    
-    # Build FFmpeg command
-    # -shortest ensures output matches shorter of video/audio
-    # -map 0:v takes video from first input
-    # -map 1:a takes audio from second input
-    cmd = [
-        "ffmpeg", "-y",
-        "-i", video_path,
-        "-i", audio_path,
-        "-map", "0:v:0",      # Video from first input
-        "-map", "1:a:0",      # Audio from second input
-        "-c:v", "copy",       # Copy video codec (no re-encode)
-        "-c:a", "aac",        # Encode audio to AAC
-        "-b:a", "192k",       # Audio bitrate
-        "-shortest",          # Match video duration
-    ]
-    
-    # Add audio filter if needed
-    if audio_filters:
-        cmd.extend(["-af", ",".join(audio_filters)])
-    
-    cmd.append(output_path)
+    if audio_path:
+        # Volume adjustment
+        if audio_volume != 1.0:
+            audio_filters.append(f"volume={audio_volume}")
+        
+        # Fade out at end of video (output length is the summed segment length)
+        if fade_out_seconds > 0:
+            video_duration = sum(probe["duration"] for probe in probes)
+            if video_duration > fade_out_seconds:
+                fade_start = video_duration - fade_out_seconds
+                audio_filters.append(f"afade=t=out:st={fade_start}:d={fade_out_seconds}")
     
-    print(f"Running: {' '.join(cmd)}")
-    result = subprocess.run(cmd, capture_output=True, text=True)
+    # Re-encodes (and their retries) would fetch every segment URL again
+    stream_output = output_sink is not None
+    remote_inputs = any(is_remote(path) for path in segment_paths)
+    if remote_inputs and not compatible:
+        raise RemoteReadError("Segment video parameters differ, segments must be downloaded")
     
-    if result.returncode != 0:
-        print(f"FFmpeg mux stderr: {result.stderr}")
+    # A logged input error means a segment was skipped even if FFmpeg
+    # exits 0, so every run fails on errors rather than truncating
+    if compatible:
+        # Create concat file list
+        temp_dir = os.path.dirname(output_path)
+        concat_file = os.path.join(temp_dir, "concat_list.txt")
         
-        # Fallback: try with video re-encoding
-        cmd = [
-            "ffmpeg", "-y",
-            "-i", video_path,
-            "-i", audio_path,
-            "-map", "0:v:0",
-            "-map", "1:a:0",
-            "-c:v", "libx264",
-            "-preset", "fast",
-            "-crf", "23",
-            "-c:a", "aac",
-            "-b:a", "192k",
-            "-shortest",
-        ]
-        if audio_filters:
-            cmd.extend(["-af", ",".join(audio_filters)])
-        cmd.append(output_path)
+        lines = []
+        for path in segment_paths:
+            if is_remote(path):
+                # URLs are read by FFmpeg directly and need quoting
+                escaped_url = path.replace("'", "'\\''")
+                lines.append(f"file '{escaped_url}'\n")
+                lines.extend(f"option {key} {value}\n" for key, value in HTTP_INPUT_OPTIONS)
+            else:
+                # Segments are downloaded next to the list with generated names
+                # (segment_000.mp4, ...), so bare file names need no quoting or
+                # escaping. The concat demuxer resolves them relative to the list.
+                lines.append(f"file {os.path.basename(path)}\n")
+        with open(concat_file, "wb") as f:
+            f.write("".join(lines).encode())
+        
+        print(f"Concat file created: {concat_file}")
         
-        print(f"Retrying with video re-encode: {' '.join(cmd)}")
-        result = subprocess.run(cmd, capture_output=True, text=True)
+        # Stream copy first
+        cmd = build_stitch_cmd(
+            concat_file, output_path,
+            audio_path=audio_path, audio_filters=audio_filters,
+            stream_output=stream_output
+        )
+        print(f"Running: {' '.join(cmd)}")
+        returncode, progress, errors, output = run_ffmpeg(cmd, output_sink, fail_on_errors=True)
+        if returncode != 0:
+            print(f"FFmpeg stderr: {errors}")
+            if remote_inputs:
+                raise RemoteReadError(f"Stream copy from segment URLs failed: {errors}")
+        
+        build_reencode_cmd = lambda gpu: build_stitch_cmd(
+            concat_file, output_path, reencode=True,
+            audio_path=audio_path, audio_filters=audio_filters,
+            stream_output=stream_output, use_gpu=gpu
+        )
+    else:
+        # The concat demuxer cannot switch codecs mid-stream
+        print("Segment video parameters differ, joining with the concat filter")
+        returncode = None
+        build_reencode_cmd = lambda gpu: build_filter_concat_cmd(
+            segment_paths, probes, output_path,
+            audio_path=audio_path, audio_filters=audio_filters,
+            stream_output=stream_output, use_gpu=gpu
+        )
+    
+    if returncode != 0:
+        # Re-encode (stream copy failed or was never possible)
+        use_gpu = use_nvenc(output_path)
+        cmd = build_reencode_cmd(use_gpu)
+        print(f"Running re-encode: {' '.join(cmd)}")
+        returncode, progress, errors, output = run_ffmpeg(cmd, output_sink, fail_on_errors=True)
         
-        if result.returncode != 0:
-            raise Exception(f"FFmpeg mux failed: {result.stderr}")
+        if returncode != 0 and use_gpu:
+            print(f"FFmpeg stderr: {errors}")
+            # NVENC/CUDA can reject some inputs; fall back to the CPU encoder
+            cmd = build_reencode_cmd(False)
+            print(f"Retrying with CPU re-encode: {' '.join(cmd)}")
+            returncode, progress, errors, output = run_ffmpeg(cmd, output_sink, fail_on_errors=True)
+    
+    if returncode != 0:
+        raise Exception(f"FFmpeg failed: {errors}")
     
-    output_size = os.path.getsize(output_path)
-    final_duration = get_video_duration(output_path)
+    # FFmpeg's final progress report carries the size and duration; only
+    # stat/probe the output file if it did not
+    duration = progress_duration(progress)
+    output_size = progress_size(progress)
+    if not stream_output:
+        if not output_size:
+            output_size = os.path.getsize(output_path)
+        if duration is None:
+            duration = get_video_duration(output_path)
+    duration = duration or 0.0
     
-    print(f"Muxed output: {output_size:,} bytes, {final_duration:.2f}s")
+    print(f"Output: {output_size:,} bytes, {duration:.2f}s")
     
     return {
         "success": True,
-        "duration": final_duration,
+        "duration": duration,
         "file_size_bytes": output_size,
-        "has_audio": True
+        "segments_count": len(segment_paths),
+        "has_audio": bool(audio_path),
+        "output": output
     }
 
 
+def stitch_with_audio(
+    segment_paths: List[str],
+    output_path: str,
+    audio_path: Optional[str] = None,
+    audio_volume: float = 1.0,
+    fade_out_seconds: float = 0.0,
+    output_sink: Optional[Callable[[BinaryIO], Any]] = None,
+    probes: Optional[List[dict]] = None
+) -> dict:
+    """Stitch segments with the audio track, falling back to video-only output if muxing fails."""
+    if audio_path:
+        try:
+            result = stitch_videos_ffmpeg(
+                segment_paths,
+                output_path,
+                audio_path=audio_path,
+                audio_volume=audio_volume,
+                fade_out_seconds=fade_out_seconds,
+                output_sink=output_sink,
+                probes=probes
+            )
+            print("Audio muxing successful")
+            return result
+        except (OutputSinkError, InputReadError, RemoteReadError):
+            raise
+        except Exception as audio_err:
+            print(f"Audio muxing error: {str(audio_err)}")
+            print("Continuing with video-only output")
+    
+    return stitch_videos_ffmpeg(segment_paths, output_path, output_sink=output_sink, probes=probes)
+
+
+def stitch_to_output(
+    segment_paths: List[str],
+    output_path: str,
+    audio_path: Optional[str] = None,
+    audio_volume: float = 1.0,
+    fade_out_seconds: float = 0.0,
+    output_sink: Optional[Callable[[BinaryIO], Any]] = None,
+    probes: Optional[List[dict]] = None
+) -> dict:
+    """Stitch into output_sink, falling back to writing output_path if the sink fails."""
+    try:
+        return stitch_with_audio(
+            segment_paths,
+            output_path,
+            audio_path=audio_path,
+            audio_volume=audio_volume,
+            fade_out_seconds=fade_out_seconds,
+            output_sink=output_sink,
+            probes=probes
+        )
+    except OutputSinkError as sink_err:
+        print(f"Streaming output failed: {str(sink_err)}")
+        print("Falling back to file output")
+        return stitch_with_audio(
+            segment_paths,
+            output_path,
+            audio_path=audio_path,
+            audio_volume=audio_volume,
+            fade_out_seconds=fade_out_seconds,
+            probes=probes
+        )
+
+
 def handler(job: dict) -> dict:
     """
     RunPod handler for video stitching with optional audio overlay.
@@ -298,11 +1168,16 @@ def handler(job: dict) -> dict:
         audio_volume: float (optional) - Volume multiplier, default 1.0
         fade_out: float (optional) - Fade out duration in seconds, default 0
         output_format: str - Output format (mp4 or webm), default: mp4
+        return_base64: bool (optional) - Skip storage upload and return base64, default False
         
     Output:
-        video_url: str - Public URL of uploaded video (if Supabase configured)
-        video_base64: str - Base64-encoded video (fallback if no Supabase)
-        duration: float - Total duration in seconds
+        video_url: str - Presigned S3/RunPod bucket URL or public Supabase URL (if storage configured)
+        video_base64: str - Base64-encoded video (fallback if no storage, or return_base64)
+            MP4 sent to S3 or returned as base64 is fragmented MP4 (empty moov,
+            fragments at keyframes) because it is streamed from FFmpeg;
+            Supabase and RunPod bucket uploads get a regular MP4.
+        duration: float - Approximate duration in seconds, taken from FFmpeg's
+            progress report (can be about one frame short of ffprobe's duration)
         file_size_bytes: int - Output file size
         has_audio: bool - Whether audio was muxed
     """
@@ -310,65 +1185,145 @@ def handler(job: dict) -> dict:
     
     # Validate input
     segments = job_input.get("segments", [])
-    if not segments or len(segments) < 2:
+    if not isinstance(segments, list) or len(segments) < 2:
         return {"error": "At least 2 video segment URLs are required"}
+    if not all(isinstance(url, str) for url in segments):
+        return {"error": "Video segment URLs must be strings"}
     
     output_format = job_input.get("output_format", "mp4")
     audio_url = job_input.get("audio_url")
     audio_volume = float(job_input.get("audio_volume", 1.0))
     fade_out = float(job_input.get("fade_out", 0.0))
+    return_base64 = job_input.get("return_base64", False)
+    if not isinstance(return_base64, bool):
+        return {"error": "return_base64 must be a boolean"}
+    
+    mime_type = "video/webm" if output_format == "webm" else "video/mp4"
+    data_uri_prefix = f"data:{mime_type};base64,"
     
     print(f"Job received: {len(segments)} segments, format={output_format}")
     if audio_url:
         print(f"Audio overlay requested: {audio_url[:80]}...")
     
-    # Create temp directory
-    temp_dir = tempfile.mkdtemp(prefix="stitch_")
-    stitched_path = os.path.join(temp_dir, f"stitched.{output_format}")
-    final_path = os.path.join(temp_dir, f"final.{output_format}")
+    temp_dir = None
     
     try:
-        # Download all video segments
-        segment_paths = []
-        for i, url in enumerate(segments):
-            path = download_file(url, temp_dir, "segment", i)
-            segment_paths.append(path)
+        # HEAD the segment and audio URLs first: with every segment length
+        # known, FFmpeg can read them directly, and the lengths size the job
+        # against RAM-backed /dev/shm.
+        remote_sizes = get_remote_sizes(segments + ([audio_url] if audio_url else []))
+        segment_sizes = remote_sizes[:len(segments)]
+        audio_size = remote_sizes[len(segments)] if audio_url else 0
+        read_remote = all(size is not None for size in segment_sizes)
         
-        # Stitch videos
-        stitch_result = stitch_videos_ffmpeg(segment_paths, stitched_path)
+        # Segment URLs are only read for stream copy; segments that need
+        # re-encoding are downloaded so the re-encode retries stay local
+        probes = None
+        if read_remote:
+            probes = probe_segments(segments)
+            read_remote = segments_compatible(probes)
+            if not read_remote:
+                print("Segments need re-encoding, downloading them")
+        
+        # Create temp directory
+        temp_root = choose_temp_root(segment_sizes, audio_size)
+        temp_dir = tempfile.mkdtemp(prefix="stitch_", dir=temp_root)
+        output_path = os.path.join(temp_dir, f"final.{output_format}")
+        
+        try:
+            segment_paths, audio_path = download_inputs(segments, audio_url, temp_dir, read_remote)
+        except TempSpaceError as space_err:
+            if temp_root is None:
+                raise
+            print(f"{str(space_err)}, moving job files to disk")
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            temp_dir = tempfile.mkdtemp(prefix="stitch_")
+            output_path = os.path.join(temp_dir, f"final.{output_format}")
+            segment_paths, audio_path = download_inputs(segments, audio_url, temp_dir, read_remote)
+        
+        # Pick the output destination. S3 uploads and base64 encoding read
+        # FFmpeg's MP4 stdout directly so the output never touches disk;
+        # WebM, Supabase and RunPod bucket uploads need the finished file.
+        s3 = None if return_base64 else get_s3_client()
+        file_upload_configured = bool(
+            (os.environ.get("SUPABASE_URL") and os.environ.get("SUPABASE_SERVICE_ROLE_KEY"))
+            or runpod_bucket_configured()
+        )
+        
+        if output_format != "mp4":
+            output_sink = None
+        elif s3:
+            s3_client, s3_bucket = s3
+            output_sink = lambda stream: upload_stream_to_s3(
+                stream, s3_client, s3_bucket, f".{output_format}"
+            )
+        elif return_base64 or not file_upload_configured:
+            output_sink = lambda stream: encode_stream_base64(stream, data_uri_prefix)
+        else:
+            output_sink = None
+        
+        # Stitch videos, muxing the audio track in the same FFmpeg pass.
+        # Probe once here: the stitch retries reuse the results.
+        if not read_remote:
+            probes = probe_segments(segment_paths)
+        try:
+            stitch_result = stitch_to_output(
+                segment_paths,
+                output_path,
+                audio_path=audio_path,
+                audio_volume=audio_volume,
+                fade_out_seconds=fade_out,
+                output_sink=output_sink,
+                probes=probes
+            )
+        except Exception as remote_err:
+            if not read_remote:
+                raise
+            print(f"Reading segments over HTTP failed: {str(remote_err)}")
+            print("Falling back to downloading segments")
+            segment_paths = download_segments(segments, temp_dir)
+            stitch_result = stitch_to_output(
+                segment_paths,
+                output_path,
+                audio_path=audio_path,
+                audio_volume=audio_volume,
+                fade_out_seconds=fade_out,
+                output_sink=output_sink,
+                probes=probe_segments(segment_paths)
+            )
         
         if not stitch_result.get("success"):
             return {"error": stitch_result.get("error", "Stitching failed")}
         
-        # Mux audio if provided
-        has_audio = False
-        output_path = stitched_path
+        # FFmpeg has read the inputs once; don't let them crowd the page cache
+        for path in segment_paths + ([audio_path] if audio_path else []):
+            if not is_remote(path):
+                drop_page_cache(path)
         
-        if audio_url:
-            try:
-                audio_path = download_file(audio_url, temp_dir, "audio", 0)
-                mux_result = mux_audio_to_video(
-                    stitched_path, 
-                    audio_path, 
-                    final_path,
-                    audio_volume=audio_volume,
-                    fade_out_seconds=fade_out
-                )
-                if mux_result.get("success"):
-                    output_path = final_path
-                    has_audio = True
-                    print("Audio muxing successful")
-                else:
-                    print(f"Audio muxing failed, returning video without audio")
-            except Exception as audio_err:
-                print(f"Audio muxing error: {str(audio_err)}")
-                print("Continuing with video-only output")
+        has_audio = stitch_result["has_audio"]
+        final_duration = stitch_result["duration"]
+        final_size = stitch_result["file_size_bytes"]
         
-        # Try to upload to Supabase first (avoids base64 memory issues)
-        video_url = upload_to_supabase(output_path)
+        video_url = None
+        video_base64 = None
         
-        final_duration = get_video_duration(output_path)
-        final_size = os.path.getsize(output_path)
+        if stitch_result["output"] is None:
+            # Try to upload to storage first (avoids base64 memory issues)
+            if not return_base64:
+                video_url = (
+                    (s3 and upload_to_s3(output_path, *s3))
+                    or upload_to_supabase(output_path)
+                    or upload_to_runpod_bucket(output_path)
+                )
+            if not video_url:
+                # Fallback to base64 if upload fails
+                print(f"Encoding {final_size:,} bytes as base64...")
+                video_base64 = encode_file_base64(output_path, data_uri_prefix, final_size)
+            drop_page_cache(output_path)
+        elif s3:
+            video_url = stitch_result["output"]
+        else:
+            video_base64 = stitch_result["output"]
         
         if video_url:
             # Return URL-based response (preferred)
@@ -381,17 +1336,8 @@ def handler(job: dict) -> dict:
                 "has_audio": has_audio
             }
         else:
-            # Fallback to base64 if upload fails
-            with open(output_path, "rb") as f:
-                video_bytes = f.read()
-            
-            print(f"Encoding {len(video_bytes):,} bytes as base64...")
-            
-            mime_type = "video/webm" if output_format == "webm" else "video/mp4"
-            video_base64 = base64.b64encode(video_bytes).decode("utf-8")
-            
             return {
-                "video_base64": f"data:{mime_type};base64,{video_base64}",
+                "video_base64": video_base64,
                 "duration": final_duration,
                 "file_size_bytes": final_size,
                 "segments_count": stitch_result["segments_count"],
@@ -407,12 +1353,15 @@ def handler(job: dict) -> dict:
         
     finally:
         # Cleanup temp files
-        import shutil
         try:
-            shutil.rmtree(temp_dir, ignore_errors=True)
+            if temp_dir:
+                shutil.rmtree(temp_dir, ignore_errors=True)
         except:
             pass
 
 
-# RunPod serverless entry point
-runpod.serverless.start({"handler": handler})
+if __name__ == "__main__":
+    print(f"Worker CPUs available to FFmpeg: {os.cpu_count()}")
+    
+    # RunPod serverless entry point
+    runpod.serverless.start({"handler": handler})
@@ -0,0 +1,280 @@
+"""Tests for handler.py, run against a local HTTP server and the ffmpeg on PATH."""
+
+import base64
+import os
+import shutil
+import subprocess
+import sys
+import threading
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import handler
+
+pytestmark = pytest.mark.skipif(
+    not (shutil.which("ffmpeg") and shutil.which("ffprobe")),
+    reason="ffmpeg and ffprobe are required"
+)
+
+STORAGE_ENV_VARS = [
+    "S3_BUCKET",
+    "SUPABASE_URL",
+    "SUPABASE_SERVICE_ROLE_KEY",
+    "BUCKET_ENDPOINT_URL",
+    "BUCKET_ACCESS_KEY_ID",
+    "BUCKET_SECRET_ACCESS_KEY",
+]
+
+
+class SegmentRequestHandler(SimpleHTTPRequestHandler):
+    """Serves a directory, but fails GET for broken_* files and HEAD for nohead_* files."""
+    
+    def do_HEAD(self):
+        if os.path.basename(self.path).startswith("nohead_"):
+            self.send_error(405)
+            return
+        super().do_HEAD()
+    
+    def do_GET(self):
+        if os.path.basename(self.path).startswith("broken_"):
+            self.send_error(404)
+            return
+        super().do_GET()
+    
+    def log_message(self, format, *args):
+        pass
+
+
+def make_segment(path: str, duration: float = 2.0) -> None:
+    """Write a short H.264/AAC test clip."""
+    cmd = [
+        "ffmpeg", "-y", "-loglevel", "error",
+        "-f", "lavfi", "-i", f"testsrc=d={duration}:s=320x240:r=25",
+        "-f", "lavfi", "-i", f"sine=d={duration}",
+        "-c:v", "libx264", "-pix_fmt", "yuv420p",
+        "-c:a", "aac",
+        "-shortest",
+        path
+    ]
+    subprocess.run(cmd, check=True)
+
+
+def make_red_segment(path: str) -> None:
+    """Write a solid red MPEG-4 Part 2 clip at another size and frame rate, with no audio."""
+    cmd = [
+        "ffmpeg", "-y", "-loglevel", "error",
+        "-f", "lavfi", "-i", "color=c=red:s=640x360:r=30:d=2",
+        "-c:v", "mpeg4",
+        path
+    ]
+    subprocess.run(cmd, check=True)
+
+
+def center_pixel(path: str, seconds: float) -> bytes:
+    """RGB value of the centre of the frame shown at `seconds`."""
+    cmd = [
+        "ffmpeg", "-v", "error",
+        "-ss", str(seconds), "-i", path,
+        "-frames:v", "1",
+        "-vf", "crop=2:2,scale=1:1",
+        "-f", "rawvideo", "-pix_fmt", "rgb24",
+        "-"
+    ]
+    return subprocess.run(cmd, capture_output=True, check=True).stdout
+
+
+@pytest.fixture(autouse=True)
+def no_storage(monkeypatch):
+    """Run every job without upload credentials so results come back as base64."""
+    for name in STORAGE_ENV_VARS:
+        monkeypatch.delenv(name, raising=False)
+
+
+@pytest.fixture
+def segment_server(tmp_path):
+    """Serve seg0.mp4, seg1.mp4, broken_seg1.mp4 and nohead_seg1.mp4 over HTTP; yields the base URL."""
+    make_segment(str(tmp_path / "seg0.mp4"))
+    make_segment(str(tmp_path / "seg1.mp4"))
+    shutil.copy(tmp_path / "seg1.mp4", tmp_path / "broken_seg1.mp4")
+    shutil.copy(tmp_path / "seg1.mp4", tmp_path / "nohead_seg1.mp4")
+    
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", 0),
+        partial(SegmentRequestHandler, directory=str(tmp_path))
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_remote_segments_are_stitched(segment_server):
+    result = handler.handler({"input": {
+        "segments": [f"{segment_server}/seg0.mp4", f"{segment_server}/seg1.mp4"]
+    }})
+    
+    assert "error" not in result
+    assert result["video_base64"].startswith("data:video/mp4;base64,")
+    assert result["duration"] == pytest.approx(4.0, abs=0.2)
+
+
+def test_segment_failing_get_is_not_dropped(segment_server):
+    # HEAD succeeds, so FFmpeg is first pointed at the URL; its GET then fails
+    result = handler.handler({"input": {
+        "segments": [f"{segment_server}/seg0.mp4", f"{segment_server}/broken_seg1.mp4"]
+    }})
+    
+    assert "video_base64" not in result
+    assert "404" in result["error"]
+
+
+def test_undecodable_segment_is_not_dropped(segment_server, tmp_path):
+    # HEAD and GET both succeed, but the file is not video
+    (tmp_path / "junk.mp4").write_bytes(os.urandom(32 * 1024))
+    cmd = [
+        "ffmpeg", "-y", "-loglevel", "error",
+        "-f", "lavfi", "-i", "sine=d=4",
+        str(tmp_path / "narration.wav")
+    ]
+    subprocess.run(cmd, check=True)
+    
+    result = handler.handler({"input": {
+        "segments": [f"{segment_server}/seg0.mp4", f"{segment_server}/junk.mp4"],
+        "audio_url": f"{segment_server}/narration.wav"
+    }})
+    
+    assert "video_base64" not in result
+    assert "error" in result
+
+
+def test_mismatched_segments_are_all_kept(segment_server, tmp_path, monkeypatch):
+    # A red clip with other codec and parameters between the two H.264 segments
+    make_red_segment(str(tmp_path / "red.mp4"))
+    
+    # Re-encodes must read downloaded copies, not the segment URLs
+    filter_inputs = []
+    build_filter_concat_cmd = handler.build_filter_concat_cmd
+    def record_inputs(segment_paths, *args, **kwargs):
+        filter_inputs.extend(segment_paths)
+        return build_filter_concat_cmd(segment_paths, *args, **kwargs)
+    monkeypatch.setattr(handler, "build_filter_concat_cmd", record_inputs)
+    
+    result = handler.handler({"input": {
+        "segments": [
+            f"{segment_server}/seg0.mp4",
+            f"{segment_server}/red.mp4",
+            f"{segment_server}/seg1.mp4",
+        ],
+        "return_base64": True
+    }})
+    
+    assert "error" not in result
+    stitched = tmp_path / "stitched.mp4"
+    stitched.write_bytes(base64.b64decode(result["video_base64"].split(",", 1)[1]))
+    red, green, blue = center_pixel(str(stitched), 3.0)
+    assert red > 200 and green < 60 and blue < 60
+    assert filter_inputs and not any(handler.is_remote(path) for path in filter_inputs)
+
+
+def test_temp_root_counts_audio(monkeypatch, tmp_path):
+    monkeypatch.setattr(handler, "SHM_DIR", str(tmp_path))
+    monkeypatch.setattr(handler.shutil, "disk_usage", lambda path: SimpleNamespace(total=1000, used=0, free=1000))
+    
+    assert handler.choose_temp_root([300, 100], 100) == str(tmp_path)
+    assert handler.choose_temp_root([300, 100], 300) is None
+    # The total can't be bounded with an unknown size
+    assert handler.choose_temp_root([300, None], 100) is None
+    assert handler.choose_temp_root([300, 100], None) is None
+
+
+def test_download_too_large_for_shm_moves_to_disk(segment_server, monkeypatch, tmp_path):
+    shm_dir = tmp_path / "shm"
+    shm_dir.mkdir()
+    make_red_segment(str(tmp_path / "red.mp4"))
+    disk_usage = shutil.disk_usage
+    
+    # Room for the job upfront, but full by the time the downloads start
+    def fake_disk_usage(path):
+        if str(path) == str(shm_dir):
+            return SimpleNamespace(total=10 ** 9, used=0, free=10 ** 9)
+        if str(path).startswith(str(shm_dir)):
+            return SimpleNamespace(total=10 ** 9, used=10 ** 9, free=0)
+        return disk_usage(path)
+    monkeypatch.setattr(handler, "SHM_DIR", str(shm_dir))
+    monkeypatch.setattr(handler.shutil, "disk_usage", fake_disk_usage)
+    
+    # Mismatched segments are downloaded for the re-encode
+    result = handler.handler({"input": {
+        "segments": [f"{segment_server}/seg0.mp4", f"{segment_server}/red.mp4"]
+    }})
+    
+    assert "error" not in result
+    assert result["duration"] == pytest.approx(4.0, abs=0.2)
+    assert os.listdir(shm_dir) == []
+
+
+def test_disk_downloads_skip_the_shm_space_check(segment_server, monkeypatch, tmp_path):
+    monkeypatch.setattr(handler, "SHM_DIR", str(tmp_path / "no-shm"))
+    monkeypatch.setattr(handler.shutil, "disk_usage", lambda path: SimpleNamespace(total=1000, used=1000, free=0))
+    
+    # No HEAD length for the second segment, so both are downloaded to disk
+    result = handler.handler({"input": {
+        "segments": [f"{segment_server}/seg0.mp4", f"{segment_server}/nohead_seg1.mp4"]
+    }})
+    
+    assert "error" not in result
+    assert result["duration"] == pytest.approx(4.0, abs=0.2)
+
+
+def test_non_string_segments_are_rejected():
+    result = handler.handler({"input": {"segments": [1, 2]}})
+    
+    assert "error" in result
+
+
+@pytest.mark.parametrize("frames, exit_code", [
+    (9, 3),     # ~1 MB: a single PutObject
+    (180, 3),   # ~20 MB: a multipart upload
+    (180, 0),
+])
+def test_failed_ffmpeg_leaves_no_s3_object(monkeypatch, frames, exit_code):
+    moto = pytest.importorskip("moto")
+    boto3 = pytest.importorskip("boto3")
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    
+    # FFmpeg writes all of its output, then the command exits with exit_code
+    cmd = [
+        "sh", "-c",
+        "ffmpeg -loglevel error -f lavfi -i testsrc=s=320x240 "
+        f"-frames:v {frames} -pix_fmt yuv420p -f rawvideo pipe:1; exit {exit_code}"
+    ]
+    
+    with moto.mock_aws():
+        s3 = boto3.client("s3")
+        s3.create_bucket(Bucket="stitched")
+        
+        returncode, _, _, url = handler.run_ffmpeg(
+            cmd, lambda stream: handler.upload_stream_to_s3(stream, s3, "stitched")
+        )
+        
+        objects = s3.list_objects_v2(Bucket="stitched").get("KeyCount", 0)
+        uploads = s3.list_multipart_uploads(Bucket="stitched").get("Uploads", [])
+    
+    assert returncode == exit_code
+    assert uploads == []
+    if exit_code:
+        assert url is None
+        assert objects == 0
+    else:
+        assert url.startswith("https://")
+        assert objects == 1